@@ -1,19 +1,36 @@
 """Class for storing deployment configurations."""
 
 import os
-from yaml import load, SafeLoader
-from schema import Schema, Use, Optional, SchemaError
+import stat
+import copy
+from collections import OrderedDict
+from typing import Dict, List, Set, Tuple
 
+from depswarm._internal.utils.yamlutils import load_yaml
 from depswarm._internal.exceptions.deploymentconfigexceptions import \
     CircularDependencyException
 
+# LRU cache of raw (unvalidated) configs keyed by (path, mtime, size).
+_YAML_CACHE = OrderedDict()
+_YAML_CACHE_MAX = 100
+
+
+# json is imported lazily to keep CLI startup fast when the JSON
+# config cache is not used.
+# pylint: disable=import-outside-toplevel
+
 
 class DeploymentConfig(dict):
     """Class for storing deployment configurations."""
 
-    def __init__(self, path: str, dependency_chain=None):
+    def __init__(self, path: str, dependency_chain=None, registry=None):
         """Initialize a DepencyConfig.
 
+        :param str path: The absolute path of the stack directory.
+        :param list dependency_chain: The stacks depending on this stack.
+        :param dict registry: Already loaded DeploymentConfigs by stack path.
+                              Shared dependencies are only loaded once.
+
         :raise CircularDependencyException: If there's a circular dependency.
         """
 
@@ -22,27 +39,30 @@ class DeploymentConfig(dict):
         self["_path"] = path
         self.dependency_chain = dependency_chain
 
-        self.schema = Schema({
-            Optional("deploy", default={}): {str: [Use(self.resolve_partial)]},
-            Optional("depends", default={}): {str: [Use(self.resolve_stack)]}
-        })
+        # The stack name and the common stack root are needed for resolving
+        # every partial and dependency, so compute them only once.
+        self._base = os.path.normpath(os.path.join(path, os.pardir))
+        self._stackname = os.path.basename(os.path.normpath(path))
+        self.registry = registry if registry is not None else {}
 
         # Make sure there are no circular dependencies.
         if self.stack in dependency_chain:
-            self.dependency_chain.append(self.stack)
             raise CircularDependencyException(
                 "Circular dependency on stack {}. Dependency chain: {}"
-                .format(self.stack, " -> ".join(self.dependency_chain))
+                .format(
+                    self.stack,
+                    " -> ".join(self.dependency_chain + [self.stack])
+                )
             )
 
-        # Add this stack to the dependency chain so that stacks after
-        # this one also get the correct chain.
-        self.dependency_chain.append(self.stack)
-
         self.from_stack(self["_path"])
 
         super().__init__(self)
 
+        # Only register fully loaded stacks so that stacks which are still
+        # being loaded go through the circular dependency check above.
+        self.registry[os.path.normpath(path)] = self
+
     @property
     def path(self) -> str:
         """Get the absolute path of the stack."""
@@ -51,7 +71,7 @@ class DeploymentConfig(dict):
     @property
     def stack(self) -> str:
         """Get the name of the stack."""
-        return os.path.basename(os.path.normpath(self.path))
+        return self._stackname
 
     def resolve_stack(self, stack: str) -> str:
         """Resolve a stack name "relative" to the current stack path.
@@ -64,46 +84,136 @@ class DeploymentConfig(dict):
         :rtype: DeploymentConfig
         """
 
-        base = os.path.normpath(os.path.join(self["_path"], ".."))
-        stackpath = os.path.join(base, stack)
+        stackpath = os.path.normpath(os.path.join(self._base, stack))
+
+        if stackpath in self.registry:
+            return self.registry[stackpath]
+
+        # Extend the dependency chain into a new list to avoid polluting
+        # parallel dependency chains.
+        return DeploymentConfig(
+            stackpath,
+            self.dependency_chain + [self.stack],
+            self.registry
+        )
+
+    def resolve_partials(
+        self,
+        partials: List[str],
+        listings: Dict[str, Set[str]] = None
+    ) -> List[str]:
+        """Resolve partial names "relative" to the current stack path.
+
+        Each stack.d directory is only listed once instead of checking
+        every partial separately.
+
+        :param List[str] partials: The names of the partials to resolve.
+        :param Dict[str, Set[str]] listings: Already listed files by
+                                             stack.d directory.
+
+        :return: The absolute paths to the partials.
+        :rtype: List[str]
+
+        :raise ValueError: If a partial name format is invalid.
+        :raise FileNotFoundError: If a partial doesn't exist.
+        """
+
+        if listings is None:
+            listings = {}
+
+        resolved = []
+        for partial in partials:
+            stack, sep, name = partial.rpartition("/")
+
+            # If the partial is just a filename, try to find it in the
+            # current stack. If it's a path with a single / symbol, try to
+            # find the it in the stack specified before the / symbol.
+            # For example
+            #   foo.yml => Search for foo.yml in the current stack.
+            #   foo/bar.yml => Search for bar.yml in stack foo.
+            if not sep:
+                directory = os.path.join(self["_path"], "stack.d")
+            elif "/" not in stack:
+                directory = os.path.join(self._base, stack, "stack.d")
+            else:
+                raise ValueError("Invalid partial: {}".format(partial))
+
+            if directory not in listings:
+                listings[directory] = self.list_files(directory)
+
+            partialpath = os.path.join(directory, name)
+            if name not in listings[directory]:
+                raise FileNotFoundError(
+                    "No such partial: {}".format(partialpath)
+                )
+
+            resolved.append(partialpath)
+
+        return resolved
+
+    @staticmethod
+    def list_files(directory: str) -> Set[str]:
+        """List the names of the files in a directory.
+
+        :param str directory: The directory to list.
+
+        :return: The file names or an empty set if the directory
+                 can't be listed.
+        :rtype: Set[str]
+        """
+
+        try:
+            return {e.name for e in os.scandir(directory) if e.is_file()}
+        except OSError:
+            return set()
 
-        # Copy the dependency chain to avoid polluting parallel
-        # dependency chains.
-        tmp = self.dependency_chain.copy()
-        return DeploymentConfig(stackpath, tmp)
+    @staticmethod
+    def validate_config(config: dict) -> dict:
+        """Validate the structure of a raw config.
 
-    def resolve_partial(self, partial: str) -> str:
-        """Resolve a partial name "relative" to the current stack path.
+        Partials and dependencies are only checked to be strings. They
+        are resolved separately.
 
-        :param str partial: The name of the partial to resolve.
+        :param dict config: The raw config to validate.
 
-        :return: The absolute path to the partial.
-        :rtype: str
+        :return: The config with defaults for missing keys.
+        :rtype: dict
 
-        :raise ValueError: If the partial name format is invalid.
-        :raise FileNotFoundError: If the partial doesn't exist.
+        :raise ValueError: If the config structure is invalid.
         """
 
-        base = os.path.normpath(os.path.join(self["_path"], ".."))
-        parts = partial.split("/")
+        if not isinstance(config, dict):
+            raise ValueError("Config must be a mapping.")
 
-        # If the partial is just a filename, try to find it in the current
-        # stack. If it's a path with a single / symbol, try to find the
-        # it in the stack specified before the / symbol. For example
-        #   foo.yml => Search for foo.yml in the current stack.
-        #   foo/bar.yml => Search for bar.yml in stack foo.
-        partialpath = ""
-        if len(parts) == 1:
-            partialpath = os.path.join(self["_path"], "stack.d", partial)
-        elif len(parts) == 2:
-            partialpath = os.path.join(base, parts[0], "stack.d", parts[1])
-        else:
-            raise ValueError("Invalid partial: {}".format(partial))
+        for key in config:
+            if key not in ("deploy", "depends"):
+                raise ValueError("Unexpected key '{}'.".format(key))
 
-        if not os.path.isfile(partialpath):
-            raise FileNotFoundError("No such partial: {}".format(partialpath))
+        validated = {}
+        for key in ("deploy", "depends"):
+            targets = config.get(key, {})
+            if not isinstance(targets, dict):
+                raise ValueError("Key '{}' must be a mapping.".format(key))
 
-        return partialpath
+            for target, values in targets.items():
+                if not isinstance(target, str):
+                    raise ValueError(
+                        "Target {!r} in '{}' must be a string."
+                        .format(target, key)
+                    )
+
+                if (
+                    not isinstance(values, list)
+                    or not all(isinstance(v, str) for v in values)
+                ):
+                    raise ValueError(
+                        "Target '{}' in '{}' must be a list of strings."
+                        .format(target, key)
+                    )
+
+            validated[key] = targets
+
+        return validated
 
     def from_stack(self, path: str):
         """Load a config from file.
@@ -115,6 +225,9 @@ class DeploymentConfig(dict):
         :raise FileNotFoundError: If the stack has no configuration file.
         :raise KeyError: If the stack config contains prohibited targets.
         :raise ValueError: If the config file format is invalid.
+
+        See DeploymentConfig.resolve_partials() and
+        DeploymentConfig.resolve_stack() for other exceptions.
         """
 
         path = self["_path"]
@@ -124,22 +237,36 @@ class DeploymentConfig(dict):
         if not os.path.isabs(path):
             raise ValueError("Path must be absolute.")
 
-        if not os.path.isdir(path):
+        # Check the stack and its config with a single stat() call each.
+        try:
+            is_dir = stat.S_ISDIR(os.stat(path).st_mode)
+        except OSError:
+            is_dir = False
+
+        if not is_dir:
             raise FileNotFoundError("Stack {} doesn't exist.".format(path))
 
         conf_path = os.path.join(path, "deploy.yml")
-        if not os.path.isfile(conf_path):
+        try:
+            st = os.stat(conf_path)
+        except OSError:
+            st = None
+
+        if st is None or not stat.S_ISREG(st.st_mode):
             raise FileNotFoundError("No stack config at {}".format(path))
 
-        # Load the deployment config from file.
-        config = None
-        with open(conf_path, "r") as f:
-            config = load(f, Loader=SafeLoader)
+        # Load the deployment config from file or from the caches.
+        # The cached config is copied so that resolving the config
+        # can't modify the cached one.
+        cache_path = conf_path + ".cache.json"
+        use_json_cache = os.environ.get("DEPSWARM_CACHE") == "1"
+        raw = self.load_raw_config(conf_path, st, use_json_cache)
+        config = copy.deepcopy(raw)
 
         # Validate the config.
         try:
-            config = self.schema.validate(config)
-        except SchemaError as e:
+            config = self.validate_config(config)
+        except ValueError as e:
             raise ValueError(
                 "Invalid config file {}:\n{}"
                 .format(path, str(e))
@@ -149,5 +276,122 @@ class DeploymentConfig(dict):
         if "_path" in config:
             raise KeyError("Target _path not allowed.")
 
+        # Resolve partials and dependencies.
+        listings = {}
+        config["deploy"] = {
+            target: self.resolve_partials(partials, listings)
+            for target, partials in config["deploy"].items()
+        }
+        config["depends"] = {
+            target: [self.resolve_stack(s) for s in stacks]
+            for target, stacks in config["depends"].items()
+        }
+
+        if use_json_cache and not self.json_cache_fresh(cache_path, st):
+            self.write_json_cache(cache_path, raw)
+
         for k in config:
             self[k] = config[k]
+
+    def load_raw_config(
+        self,
+        conf_path: str,
+        conf_stat: os.stat_result,
+        use_json_cache: bool
+    ) -> dict:
+        """Load a raw, unvalidated config from file or from the caches.
+
+        :param str conf_path: The path of the config file.
+        :param os.stat_result conf_stat: The stat result of the config file.
+        :param bool use_json_cache: Load the config from a fresh JSON cache.
+
+        :return: The raw config. Must not be modified.
+        :rtype: dict
+        """
+
+        key = (conf_path, conf_stat.st_mtime_ns, conf_stat.st_size)
+        if key in _YAML_CACHE:
+            _YAML_CACHE.move_to_end(key)
+            return _YAML_CACHE[key]
+
+        cache_path = conf_path + ".cache.json"
+        cached, raw = False, None
+        if use_json_cache and self.json_cache_fresh(cache_path, conf_stat):
+            cached, raw = self.read_json_cache(cache_path)
+
+        if not cached:
+            with open(conf_path, "r") as f:
+                raw = load_yaml(f)
+
+        _YAML_CACHE[key] = raw
+        if len(_YAML_CACHE) > _YAML_CACHE_MAX:
+            _YAML_CACHE.popitem(last=False)
+
+        return raw
+
+    @staticmethod
+    def json_cache_fresh(cache_path: str, conf_stat: os.stat_result) -> bool:
+        """Check whether a JSON config cache is up to date.
+
+        :param str cache_path: The path of the JSON cache file.
+        :param os.stat_result conf_stat: The stat result of the config file.
+
+        :return: True if the cache exists and is not older than the config.
+        :rtype: bool
+        """
+
+        try:
+            cache_stat = os.stat(cache_path)
+        except FileNotFoundError:
+            return False
+
+        return cache_stat.st_mtime_ns >= conf_stat.st_mtime_ns
+
+    @staticmethod
+    def read_json_cache(cache_path: str) -> Tuple[bool, dict]:
+        """Read a raw config from a JSON cache file.
+
+        A cache file which can't be read is removed so that it gets
+        rewritten from the original config file.
+
+        :param str cache_path: The path of the JSON cache file.
+
+        :return: Whether the cache was read and the raw config.
+        :rtype: Tuple[bool, dict]
+        """
+
+        import json
+
+        try:
+            with open(cache_path, "r") as f:
+                return True, json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+
+        return False, None
+
+    @staticmethod
+    def write_json_cache(cache_path: str, config: dict):
+        """Atomically write a raw config into a JSON cache file.
+
+        Failing to write the cache is not an error since the config
+        can always be loaded from the original file instead.
+
+        :param str cache_path: The path of the JSON cache file.
+        :param dict config: The raw, unresolved config to write.
+        """
+
+        import json
+
+        tmp_path = cache_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(config, f)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
@@ -0,0 +1,188 @@
+"""Utilities for loading, dumping and merging YAML documents."""
+
+import os
+from typing import List
+
+# PyYAML is imported lazily to keep CLI startup fast when no YAML
+# documents are loaded, ie. with --help or invalid arguments.
+# pylint: disable=import-outside-toplevel
+
+
+def load_yaml(stream) -> dict:
+    """Load a YAML document using the fastest available safe loader.
+
+    The libyaml based loader is used when PyYAML was built with it.
+
+    :param stream: The stream to load the document from.
+
+    :return: The loaded document.
+    :rtype: dict
+    """
+
+    from yaml import load
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+
+    return load(stream, Loader=SafeLoader)
+
+
+def dump_yaml(data: dict) -> str:
+    """Dump a YAML document using the fastest available safe dumper.
+
+    :param dict data: The document to dump.
+
+    :return: The dumped document.
+    :rtype: str
+    """
+
+    from yaml import dump
+    try:
+        from yaml import CSafeDumper as SafeDumper
+    except ImportError:
+        from yaml import SafeDumper
+
+    return dump(data, Dumper=SafeDumper, default_flow_style=False)
+
+
+def merge_dicts(base: dict, override: dict) -> dict:
+    """Recursively merge two dicts.
+
+    Values in override replace the values in base, except for dicts
+    which are merged.
+
+    :param dict base: The dict to merge into. Not modified.
+    :param dict override: The dict to merge.
+
+    :return: The merged dict.
+    :rtype: dict
+    """
+
+    merged = dict(base)
+    for k, v in override.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = merge_dicts(merged[k], v)
+        else:
+            merged[k] = v
+
+    return merged
+
+
+def absolute_path(path: str, base: str) -> str:
+    """Make a relative path absolute.
+
+    :param str path: The path to convert.
+    :param str base: The directory relative paths are relative to.
+
+    :return: The absolute path.
+    :rtype: str
+    """
+
+    return os.path.normpath(os.path.join(base, path))
+
+
+def absolute_volume(volume, base: str):
+    """Make the source of a relative bind mount absolute.
+
+    :param volume: A volume in short or long syntax.
+    :param str base: The directory relative paths are relative to.
+
+    :return: The volume with an absolute source.
+    """
+
+    if isinstance(volume, str) and volume.startswith("."):
+        source, sep, rest = volume.partition(":")
+        return absolute_path(source, base) + sep + rest
+
+    if (
+        isinstance(volume, dict)
+        and volume.get("type") == "bind"
+        and isinstance(volume.get("source"), str)
+    ):
+        volume = dict(volume)
+        volume["source"] = absolute_path(volume["source"], base)
+
+    return volume
+
+
+def absolute_compose_paths(data: dict, base: str):
+    """Make the relative paths in a docker-compose document absolute.
+
+    The file of configs and secrets, env_file and bind mount sources of
+    services are converted.
+
+    :param dict data: The document to convert. Modified in place.
+    :param str base: The directory relative paths are relative to.
+    """
+
+    for key in ("configs", "secrets"):
+        for item in (data.get(key) or {}).values():
+            if isinstance(item, dict) and isinstance(item.get("file"), str):
+                item["file"] = absolute_path(item["file"], base)
+
+    for service in (data.get("services") or {}).values():
+        if not isinstance(service, dict):
+            continue
+
+        env_file = service.get("env_file")
+        if isinstance(env_file, str):
+            service["env_file"] = absolute_path(env_file, base)
+        elif isinstance(env_file, list):
+            service["env_file"] = [
+                absolute_path(e, base) if isinstance(e, str) else e
+                for e in env_file
+            ]
+
+        if isinstance(service.get("volumes"), list):
+            service["volumes"] = [
+                absolute_volume(v, base) for v in service["volumes"]
+            ]
+
+
+def merge_compose(paths: List[str]) -> str:
+    """Merge docker-compose files into a single document.
+
+    Later files override earlier ones. Mappings such as services, networks
+    and volumes are merged recursively while all other values, including
+    lists, are replaced. Note that Docker itself merges some lists, eg.
+    ports, so the result may differ from passing the files to Docker.
+
+    Docker resolves relative paths against the directory of the first
+    file, but against the working directory when the document is read from
+    stdin. Relative config and secret files, env_files and bind mounts are
+    therefore made absolute. Other relative paths are left as is.
+
+    :param List[str] paths: The paths of the files to merge.
+
+    :return: The merged document.
+    :rtype: str
+
+    :raise ValueError: If a file is not a valid docker-compose file.
+    """
+
+    from yaml import YAMLError
+
+    merged = {}
+    for path in paths:
+        try:
+            with open(path, "r") as f:
+                data = load_yaml(f)
+        except YAMLError as e:
+            raise ValueError(
+                "Invalid partial {}:\n{}"
+                .format(path, str(e))
+            ) from e
+
+        if data is None:
+            continue
+
+        if not isinstance(data, dict):
+            raise ValueError("Invalid partial: {}".format(path))
+
+        merged = merge_dicts(merged, data)
+
+    if paths:
+        absolute_compose_paths(merged, os.path.dirname(paths[0]))
+
+    return dump_yaml(merged)
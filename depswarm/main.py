@@ -4,102 +4,370 @@
 
 import os
 import sys
-import subprocess
-import shutil
-import json
-from typing import List
+from collections import OrderedDict, deque
+from typing import List, Tuple
 from argparse import ArgumentParser
 
 from depswarm._internal.models.deploymentconfig import DeploymentConfig
+from depswarm._internal.utils.yamlutils import merge_compose
+from depswarm._internal.exceptions.deploymentconfigexceptions import \
+    CircularDependencyException
 from depswarm._internal.exceptions.genericexceptions import \
     UnsupportedVersionException, MissingDependencyException
 
+# Modules which are only needed for deploying are imported lazily to keep
+# CLI startup fast, ie. with --help or invalid arguments.
+# pylint: disable=import-outside-toplevel
+
+# A successful Docker version check is cached in this file. See
+# docker_check_cached() for when the cache is valid.
+DOCKER_CHECK_CACHE = os.path.expanduser("~/.cache/depswarm/docker_ok")
+
+# Go template for printing the Docker Client and Engine API versions.
+DOCKER_VERSION_FORMAT = (
+    "client={{.Client.ApiVersion}}\n"
+    "{{range .Server.Components}}{{if eq .Name \"Engine\"}}"
+    "engine={{.Details.ApiVersion}}"
+    "{{end}}{{end}}"
+)
+
+
+def collect_dependencies(
+    deploymentconfig: DeploymentConfig,
+    target: str,
+    nodes: OrderedDict,
+    edges: List[Tuple[str, str]]
+):
+    """Collect the dependency graph of a stack.
+
+    :param DeploymentConfig deploymentconfig: The root stack of the graph.
+    :param str target: The deployment target to use.
+    :param OrderedDict nodes: Collected stacks by stack path.
+    :param List[Tuple[str, str]] edges: Collected (stack, dependency) paths.
+    """
+
+    if deploymentconfig.path in nodes:
+        return
+
+    for dependency in deploymentconfig["depends"].get(target, []):
+        edges.append((deploymentconfig.path, dependency.path))
+        collect_dependencies(dependency, target, nodes, edges)
+
+    # Add the stack after its dependencies to keep the declared order.
+    # DeploymentConfig guarantees there's no circular dependencies, so
+    # a stack can't be reached again while its dependencies are walked.
+    nodes[deploymentconfig.path] = deploymentconfig
+
+
+def deployment_order(
+    nodes: OrderedDict,
+    edges: List[Tuple[str, str]]
+) -> List[DeploymentConfig]:
+    """Sort a dependency graph topologically using Kahn's algorithm.
+
+    :param OrderedDict nodes: Stacks by stack path.
+    :param List[Tuple[str, str]] edges: (stack, dependency) path pairs.
+
+    :return: The stacks ordered so that dependencies come first.
+    :rtype: List[DeploymentConfig]
+    """
+
+    indegree = {path: 0 for path in nodes}
+    dependents = {path: [] for path in nodes}
+    for stack, dependency in edges:
+        indegree[stack] += 1
+        dependents[dependency].append(stack)
+
+    queue = deque(path for path in nodes if indegree[path] == 0)
+    order = []
+    while queue:
+        path = queue.popleft()
+        order.append(nodes[path])
+        for stack in dependents[path]:
+            indegree[stack] -= 1
+            if indegree[stack] == 0:
+                queue.append(stack)
+
+    # DeploymentConfig guarantees there's no circular dependencies.
+    assert len(order) == len(nodes), "Circular dependency in stack graph."
+
+    return order
+
+
+def deployment_ranks(
+    order: List[DeploymentConfig],
+    edges: List[Tuple[str, str]]
+) -> List[List[DeploymentConfig]]:
+    """Group topologically sorted stacks into independent ranks.
+
+    The rank of a stack is the length of the longest dependency path
+    below it. Stacks in the same rank don't depend on each other and
+    can be deployed concurrently once all lower ranks are deployed.
+
+    :param List[DeploymentConfig] order: Topologically sorted stacks.
+    :param List[Tuple[str, str]] edges: (stack, dependency) path pairs.
+
+    :return: The stacks grouped by rank, lowest rank first.
+    :rtype: List[List[DeploymentConfig]]
+    """
+
+    dependencies = {stack.path: [] for stack in order}
+    for stack, dependency in edges:
+        dependencies[stack].append(dependency)
+
+    rank = {}
+    ranks = []
+    for stack in order:
+        rank[stack.path] = max(
+            (rank[d] + 1 for d in dependencies[stack.path]),
+            default=0
+        )
+        if rank[stack.path] == len(ranks):
+            ranks.append([])
+        ranks[rank[stack.path]].append(stack)
+
+    return ranks
+
+
+def deploy_stack(
+    deploymentconfig: DeploymentConfig,
+    target: str,
+    dry_run: bool,
+    merge: bool = False
+) -> int:
+    """Deploy a single stack without its dependencies.
+
+    :param DeploymentConfig deploymentconfig: The stack to deploy.
+    :param str target: The deployment target to use.
+    :param bool dry_run: Only print the command which would be executed.
+    :param bool merge: Merge the partials and pass them to Docker as one
+                       document via stdin.
+
+    :return: The return value of 'docker stack deploy'.
+    :rtype: int
+
+    :raise ValueError: If a partial can't be merged.
+    """
+
+    import subprocess
+
+    # Build the command for deployment. Repeated partials are only passed
+    # once. The last occurrence is kept since later partials override
+    # earlier ones.
+    partials = deploymentconfig["deploy"][target]
+    partials = list(reversed(OrderedDict.fromkeys(reversed(partials))))
+
+    if merge:
+        cmd = ["docker", "stack", "deploy", "-c", "-"]
+        cmd.append(deploymentconfig.stack)
+        print("-- " + " ".join(cmd) + " < " + " + ".join(partials))
+    else:
+        cmd = ["docker", "stack", "deploy"]
+        for partial in partials:
+            cmd.extend(["-c", partial])
+        cmd.append(deploymentconfig.stack)
+        print("-- " + " ".join(cmd))
+
+    if dry_run:
+        return 0
+
+    # Deploy the stack.
+    try:
+        if merge:
+            return subprocess.run(
+                cmd,
+                input=merge_compose(partials),
+                universal_newlines=True,
+                check=False
+            ).returncode
+
+        return subprocess.run(cmd, check=False).returncode
+    except OSError as e:
+        print("[ERROR] " + str(e))
+        return 1
+
 
 def deploy(
     deploymentconfig: DeploymentConfig,
     target: str,
     no_deps: bool,
-    dry_run: bool
+    dry_run: bool,
+    merge: bool = False
 ) -> int:
     """Deploy a stack and its dependencies.
 
+    Each stack is deployed only once even if multiple stacks depend on
+    it. Stacks which don't depend on each other are deployed concurrently,
+    except on dry runs. Deployment stops after the first rank of stacks
+    where a stack fails to deploy.
+
     :param DeploymentConfig deploymentconfig: The root stack to deploy.
     :param str target: The deployment target to use.
     :param bool no_deps: Don't deploy dependencies.
+    :param bool dry_run: Only print commands which would be executed.
+    :param bool merge: Merge the partials of each stack into one document.
 
-    :return: The return value of 'docker stack deploy'.
+    :return: The return value of the first failed 'docker stack deploy'
+             or 0 on success.
     :rtype: int
 
-    :raise ValueError: If there's no partials defined for the stack.
+    :raise ValueError: If there's no partials defined for a stack.
+    :raise ValueError: If a partial can't be merged.
     """
 
-    # Make sure the target can be deployed.
-    if target not in deploymentconfig["deploy"]:
-        raise ValueError(
-            "No target '{}' for stack: {}"
-            .format(target, deploymentconfig.path)
-        )
+    from concurrent.futures import ThreadPoolExecutor
+
+    if no_deps:
+        ranks = [[deploymentconfig]]
+    else:
+        nodes = OrderedDict()
+        edges = []
+        collect_dependencies(deploymentconfig, target, nodes, edges)
+        ranks = deployment_ranks(deployment_order(nodes, edges), edges)
+
+    # Make sure the target can be deployed before deploying anything.
+    for rank in ranks:
+        for stack in rank:
+            if target not in stack["deploy"]:
+                raise ValueError(
+                    "No target '{}' for stack: {}"
+                    .format(target, stack.path)
+                )
 
-    if not no_deps:
-        # Deploy dependencies first. DeploymentConfig guarantees there's no
-        # circular dependencies.
-        if target in deploymentconfig["depends"]:
-            for dependency in deploymentconfig["depends"][target]:
-                deploy(dependency, target, no_deps, dry_run)
+    # 'docker stack deploy' runs in a separate process, so threads are
+    # enough for deploying the stacks of a rank concurrently. Dry runs are
+    # serial to print the commands in a stable order.
+    for rank in ranks:
+        workers = 1 if dry_run else min(len(rank), (os.cpu_count() or 1) * 2)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                lambda stack: deploy_stack(stack, target, dry_run, merge),
+                rank
+            ))
+
+        for ret in results:
+            if ret != 0:
+                return ret
 
-    # Build the shell command for deployment.
-    cmd = ["docker", "stack", "deploy"]
-    for partial in deploymentconfig["deploy"][target]:
-        cmd.extend(["-c", partial])
-    cmd.append(deploymentconfig.stack)
+    return 0
 
-    # Deploy the stack.
-    print("-- " + " ".join(cmd))
 
-    if not dry_run:
-        return subprocess.run(
-            " ".join(cmd),
-            shell=True,
-            check=False
-        ).returncode
+def docker_check_key(docker_path: str) -> str:
+    """Get the key identifying a Docker version check.
+
+    The key contains the Docker binary and the selected daemon, since the
+    check also covers the Docker Engine API version.
+
+    :param str docker_path: The path of the Docker binary.
+
+    :return: The cache key.
+    :rtype: str
+    """
+
+    return "\n".join([
+        docker_path,
+        os.environ.get("DOCKER_HOST", ""),
+        os.environ.get("DOCKER_CONTEXT", "")
+    ])
+
+
+def docker_check_cached(docker_path: str) -> bool:
+    """Check whether a cached Docker version check is still valid.
+
+    The cache is valid if it was written for the same Docker binary and
+    daemon and neither the binary nor the Docker CLI config, which selects
+    the current context, is newer than the cache.
+
+    :param str docker_path: The path of the Docker binary.
+
+    :return: True if the check can be skipped.
+    :rtype: bool
+    """
+
+    docker_config = os.path.join(
+        os.environ.get("DOCKER_CONFIG", os.path.expanduser("~/.docker")),
+        "config.json"
+    )
+
+    try:
+        with open(DOCKER_CHECK_CACHE, "r") as f:
+            if f.read() != docker_check_key(docker_path):
+                return False
+
+        cache_mtime = os.stat(DOCKER_CHECK_CACHE).st_mtime
+        if os.stat(docker_path).st_mtime > cache_mtime:
+            return False
+    except OSError:
+        return False
+
+    try:
+        return os.stat(docker_config).st_mtime <= cache_mtime
+    except OSError:
+        return True
 
-    return 0
 
+def check_docker(check_version: bool = True):
+    """Check that Docker is installed and the version is supported.
 
-def check_docker():
-    """Check that Docker is installed and the version is supported."""
+    The version check is skipped if the environment variable
+    DEPSWARM_SKIP_CHECK is set to 1 or if a previous check with the same
+    Docker binary and daemon was successful.
+
+    :param bool check_version: Check the Docker version too.
+    """
+
+    import shutil
+    import subprocess
 
     # Make sure Docker is installed.
-    if not shutil.which("docker"):
+    docker_path = shutil.which("docker")
+    if not docker_path:
         raise MissingDependencyException(
             "Docker is required but it's not installed."
         )
 
+    if not check_version or os.environ.get("DEPSWARM_SKIP_CHECK") == "1":
+        return
+
+    if docker_check_cached(docker_path):
+        return
+
+    # Only the API versions are needed, so let Docker format them as
+    # key=value lines instead of dumping and parsing all version info.
     ret = subprocess.run(
-        "docker version --format '{{json .}}'",
-        shell=True,
+        ["docker", "version", "--format", DOCKER_VERSION_FORMAT],
         check=True,
         stdout=subprocess.PIPE,
         universal_newlines=True
     )
-    data = json.loads(ret.stdout)
+    versions = dict(
+        line.split("=", 1) for line in ret.stdout.strip().splitlines()
+    )
 
     # Check Docker Client API version.
-    client_api_ver = float(data["Client"]["ApiVersion"])
+    client_api_ver = float(versions["client"])
     if client_api_ver < 1.25:
         raise UnsupportedVersionException(
             "Docker Client API {} is not supported; must be >= 1.25."
             .format(client_api_ver)
         )
 
-    # Check Docker Server APi version.
-    for c in data["Server"]["Components"]:
-        if c["Name"] == "Engine":
-            if float(c["Details"]["ApiVersion"]) < 1.25:
-                raise UnsupportedVersionException(
-                    "Docker Server API {} is not supported; must be >= 1.25."
-                    .format(client_api_ver)
-                )
+    # Check Docker Server API version.
+    if "engine" in versions:
+        server_api_ver = float(versions["engine"])
+        if server_api_ver < 1.25:
+            raise UnsupportedVersionException(
+                "Docker Server API {} is not supported; must be >= 1.25."
+                .format(server_api_ver)
+            )
+
+    # Failing to cache the result only means the check is run again.
+    try:
+        os.makedirs(os.path.dirname(DOCKER_CHECK_CACHE), exist_ok=True)
+        with open(DOCKER_CHECK_CACHE, "w") as f:
+            f.write(docker_check_key(docker_path))
+    except OSError:
+        pass
 
 
 def main(argv: List[str]) -> int:
@@ -129,6 +397,16 @@ def main(argv: List[str]) -> int:
         action="store_true",
         help="Dry run; only print commands which would be executed."
     )
+    ap.add_argument(
+        "-m",
+        "--merge",
+        action="store_true",
+        help=(
+            "Merge partials before passing them to Docker. "
+            "Merging may differ from Docker's own merge rules and "
+            "only some relative paths are supported."
+        )
+    )
     ap.add_argument(
         "stack",
         type=str,
@@ -143,20 +421,45 @@ def main(argv: List[str]) -> int:
     args = ap.parse_args(argv[1:])
 
     try:
-        root = DeploymentConfig(os.path.abspath(args.stack))
-    except ValueError as e:
-        print("[ERROR] " + str(e))
-        return 1
-    except FileNotFoundError as e:
+        registry = {}
+        root = DeploymentConfig(
+            os.path.abspath(args.stack),
+            registry=registry
+        )
+    except (
+        ValueError,
+        FileNotFoundError,
+        KeyError,
+        CircularDependencyException
+    ) as e:
         print("[ERROR] " + str(e))
         return 1
-    except KeyError as e:
+
+    # Skip the Docker version check for trivial deployments since the
+    # version check would only delay 'docker stack deploy', which reports
+    # unsupported versions itself.
+    trivial = args.no_deps and len(root["deploy"].get(args.target, [])) <= 1
+    try:
+        check_docker(
+            not trivial
+            or os.environ.get("DEPSWARM_REQUIRE_VERSION_CHECK") == "1"
+        )
+    except (
+        UnsupportedVersionException,
+        MissingDependencyException
+    ) as e:
         print("[ERROR] " + str(e))
         return 1
 
     ret = 0
     try:
-        ret = deploy(root, args.target, args.no_deps, args.dry_run)
+        ret = deploy(
+            root,
+            args.target,
+            args.no_deps,
+            args.dry_run,
+            args.merge
+        )
     except ValueError as e:
         print("[ERROR] " + str(e))
         return 1
@@ -167,15 +470,6 @@ def main(argv: List[str]) -> int:
 def entrypoint():
     """Python package entrypoint when run as a CLI utility."""
 
-    try:
-        check_docker()
-    except UnsupportedVersionException as e:
-        print("[ERROR] " + str(e))
-        sys.exit(1)
-    except MissingDependencyException as e:
-        print("[ERROR] " + str(e))
-        sys.exit(1)
-
     sys.exit(main(sys.argv))
 
 
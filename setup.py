@@ -20,8 +20,7 @@ setuptools.setup(
     ],
     python_requires='>=3.5',
     install_requires=[
-        "schema>=0.7.4",
-        "pyaml>=20.4.0"
+        "PyYAML>=5.1"
     ],
     entry_points={
         "console_scripts": [